@@ -1,19 +1,82 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict
 import argparse
+import itertools
+import mmap
+import operator
 import os
+import pickle
 import re
+import shutil
+import stat
+import subprocess
 import sys
+import tempfile
 import urllib.request
 import glob
 
+# If we can, we decompress setup.zst in-process: with compression.zstd
+# (Python 3.14 and later) or the zstandard package.  Otherwise we run
+# the zstd program.  zstd_copy(src, dst) decompresses binary file src
+# into binary file dst, and like the zstd program raises an error if
+# src is truncated.
 try:
-    import tarjan.tc
+    from compression import zstd
+
+    # ZstdFile reads across frames, and raises EOFError if the input
+    # ends inside one.
+    def zstd_copy(src, dst):
+        with zstd.ZstdFile(src) as f:
+            shutil.copyfileobj(f, dst, _ZSTD_BLOCK_SIZE)
 except ImportError:
-    print("This program requires the tarjan package.")
-    print("Please install it and try again.")
-    sys.exit(1)
+    try:
+        import zstandard
+
+        # zstandard's stream_reader stops quietly at the end of the
+        # input, complete frame or not, and by default after the first
+        # frame.  So drive a decompressobj per frame ourselves.
+        def zstd_copy(src, dst):
+            dctx = zstandard.ZstdDecompressor()
+            dobj = dctx.decompressobj()
+            while data := src.read(_ZSTD_BLOCK_SIZE):
+                while data:
+                    if dobj.eof:
+                        dobj = dctx.decompressobj()
+                    dst.write(dobj.decompress(data))
+                    data = dobj.unused_data
+            if not dobj.eof:
+                raise EOFError("setup.zst is truncated")
+    except ImportError:
+        zstd_copy = None
+
+# Read and copy data in blocks of this size, zstd's streaming output
+# block size (ZSTD_DStreamOutSize).
+_ZSTD_BLOCK_SIZE = 128 * 1024
+
+# Patterns used by parse_setup_ini, compiled once.  They are run over
+# the whole (mmapped) file, so they are bytes patterns anchored at line
+# starts, and they must never match across a newline; hence [^\S\n]
+# rather than \s.
+
+# _LINE recognizes, in a single match, the only kinds of lines we
+# care about: a package header, the start of a [prev] or [test]
+# section, a category line putting the package in Base, or one of the
+# other keywords we use.  The name of the last group that matched tells
+# us which; for a keyword line it is the keyword itself, and the group
+# holds its value.  Other category lines don't match at all.  Almost
+# every line fails on its first byte.  Anchoring with a literal
+# newline (_NEXT_LINE_RE) rather than with ^ lets re jump straight from
+# one line start to the next instead of trying the pattern at every
+# byte; _LINE_RE handles the first line of the file.
+_LINE = (rb'(?:@[^\S\n]+(?P<pkg>\S+)'
+         rb'|(?P<end>\[(?:prev|test)\])'
+         rb'|category:[^\S\n]*(?P<base>Base\b)'
+         rb'|depends2:[^\S\n]*(?P<depends2>.*)'
+         rb'|provides:[^\S\n]*(?P<provides>.*)'
+         rb'|obsoletes:[^\S\n]*(?P<obsoletes>.*))')
+_LINE_RE = re.compile(_LINE)
+_NEXT_LINE_RE = re.compile(rb'\n' + _LINE)
+_NEXT_PKG_RE = re.compile(rb'\n@[^\S\n]')
 
 def get_setup_ini(args):
     if args.inifile:
@@ -34,11 +97,31 @@ def get_setup_ini(args):
     if arch == 'i686':
         arch = 'x86'
 
-    temp_fn, headers = urllib.request.urlretrieve('ftp://ftp.cygwin.com/pub/cygwin/' + arch + '/setup.zst')
-    zst_fn = temp_fn + '_setup.ini.zst'
-    os.rename(temp_fn, zst_fn)
-    os.system('/usr/bin/zstd -d --rm ' + zst_fn)
-    return temp_fn + '_setup.ini'
+    url = 'ftp://ftp.cygwin.com/pub/cygwin/' + arch + '/setup.zst'
+    if zstd_copy is None:
+        temp_fn, headers = urllib.request.urlretrieve(url)
+        zst_fn = temp_fn + '_setup.ini.zst'
+        os.rename(temp_fn, zst_fn)
+        try:
+            subprocess.run(['/usr/bin/zstd', '-d', '--rm', zst_fn], check=True)
+        except (OSError, subprocess.CalledProcessError) as err:
+            print("Can't decompress %s: %s" % (zst_fn, err))
+            sys.exit(1)
+        return temp_fn + '_setup.ini'
+
+    # Decompress as we download.  Write to a name that -c doesn't look
+    # for, and only rename it into place once the copy is complete, so
+    # a failed download never leaves a truncated setup.ini behind.
+    dst = tempfile.NamedTemporaryFile(suffix='_setup.ini.part', delete=False)
+    try:
+        with dst, urllib.request.urlopen(url) as resp:
+            zstd_copy(resp, dst)
+    except BaseException:
+        os.unlink(dst.name)
+        raise
+    inifile = dst.name[:-len('.part')]
+    os.replace(dst.name, inifile)
+    return inifile
 
 # Return a pair consisting of a graph and a set.  The graph is the
 # dependency graph of all packages listed in INIFILE, plus a
@@ -53,105 +136,289 @@ def get_setup_ini(args):
 # the single entry h[perl_base] = [perl5_030].  Then at the end, we
 # replace all occurrences of perl5_030 in the dependency graph by
 # perl_base.
+
+# Package names are interned: each one occurs many times in the graph,
+# and the graph algorithms below spend their time hashing and
+# comparing names.
 def parse_setup_ini(inifile):
-    g = defaultdict(list)
-    h = defaultdict(list)
+    g = {'BASE': []}
+    h = {}
     S = set()
-    with open(inifile) as f:
-        done_with_entry = False
-        for line in f:
-            match = re.match(r'^@\s+(\S+)', line)
-            if match:
-                # New package
-                name = match.group(1)
-                g[name] = []
-                done_with_entry = False
-
-            if done_with_entry:
-                continue
-
-            if line.startswith('[prev]') or line.startswith('[test]'):
-                done_with_entry = True
-                continue
-
-            match = re.match(r'^(\S+):\s*(.*)$', line)
+    with open(inifile, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # An empty file can't be mapped, and nor can a pipe such as
+            # -p <(zstd -dc setup.zst).  The regexes work on bytes too.
+            buf = f.read()
+    matches = ()
+    try:
+        first = _LINE_RE.match(buf)
+        matches = _NEXT_LINE_RE.finditer(buf)
+        if first:
+            matches = itertools.chain([first], matches)
+        while True:
+            for match in matches:
+                kind = match.lastgroup
+                if kind == 'pkg':
+                    # New package
+                    name = sys.intern(match.group('pkg').decode())
+                    g[name] = []
+                    continue
+
+                if kind == 'end':
+                    break
+
+                if kind == 'base':
+                    g['BASE'].append(name)
+                    continue
+
+                value = match.group(kind)
+                if kind == 'depends2' and value:
+                    g[name] = [sys.intern(s.strip()) for s in value.decode().split(',')]
+
+                elif kind == 'provides' and value:
+                    h[name] = [sys.intern(s.strip()) for s in value.decode().split(',')]
+
+                elif kind == 'obsoletes' and value:
+                    S |= {sys.intern(s.strip()) for s in value.decode().split(',')}
+            else:
+                break
+
+            # We only look at the current version, and a [prev] or
+            # [test] section runs to the end of the entry.  Resume the
+            # scan at the next package header.
+            match = _NEXT_PKG_RE.search(buf, match.end())
             if not match:
-                continue
-
-            keyword = match.group(1)
-            value = match.group(2)
-            if keyword == 'category' and re.match(r'\bBase\b', value):
-                g['BASE'].append(name)
+                break
+            matches = _NEXT_LINE_RE.finditer(buf, match.start())
+    finally:
+        # An unfinished scanner holds a buffer export on buf, which
+        # would stop an mmap from being closed.  Drop it first, whether
+        # or not the scan got to the end.
+        del matches
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+    # Map each provided name to its provider (the first one, if there
+    # are several), then translate every adjacency list in one pass.
+    provided_by = {}
+    for p, provides in h.items():
+        provided_by.setdefault(provides[0], p)
+    if provided_by:
+        for req in g.values():
+            for i, x in enumerate(req):
+                p = provided_by.get(x)
+                if p is not None:
+                    req[i] = p
 
-            elif keyword == 'depends2' and value:
-                g[name] = [s.strip() for s in value.split(',')]
-
-            elif keyword == 'provides' and value:
-                h[name] = [s.strip() for s in value.split(',')]
-
-            elif keyword == 'obsoletes' and value:
-                S |= {s.strip() for s in value.split(',')}
-
-    for p in h:
-        for q in g:
-            g[q] = [p if x == h[p][0] else x for x in g[q]]
+    return g, S
 
+# Parsed data is cached in pickles under _CACHE_DIR.  Each cache file
+# holds a pair (key, value), where key identifies the input the value
+# was computed from.  Failing to read or write a cache is not an error;
+# we just recompute the value.
+_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                          or os.path.expanduser('~/.cache'), 'cygcheck-dep')
+
+# Part of every cache key.  Bump it whenever the parsers change what
+# they return, so that old caches are ignored.
+_CACHE_VERSION = 1
+
+# Return the value cached in NAME if it was stored under KEY, else None.
+def read_cache(name, key):
+    try:
+        with open(os.path.join(_CACHE_DIR, name), 'rb') as f:
+            cached_key, value = pickle.load(f)
+    except Exception:
+        # Unreadable, truncated or not a pair: unpickling can fail in
+        # many ways, and any of them just means recomputing.
+        return None
+    return value if cached_key == key else None
+
+# Store VALUE in NAME under KEY.  Write to a temporary file and rename
+# it, so a concurrent reader never sees a partial cache.
+def write_cache(name, key, value):
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        f = tempfile.NamedTemporaryFile(dir=_CACHE_DIR, delete=False)
+    except OSError:
+        return
+    try:
+        with f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, os.path.join(_CACHE_DIR, name))
+    except OSError:
+        os.unlink(f.name)
+
+# Like parse_setup_ini, but use the cached result if INIFILE (same
+# path, size and modification time) was parsed before.
+def load_setup_ini(inifile):
+    st = os.stat(inifile)
+    # A pipe can't be recognized again next time.
+    if not stat.S_ISREG(st.st_mode):
+        return parse_setup_ini(inifile)
+    key = (_CACHE_VERSION, os.path.abspath(inifile), st.st_mtime_ns, st.st_size)
+    cached = read_cache('setup.ini.pkl', key)
+    if cached is not None:
+        return cached
+    g, S = parse_setup_ini(inifile)
+    write_cache('setup.ini.pkl', key, (g, S))
     return g, S
 
-# Return a list of installed packages.
+# Return a list of installed packages.  Like setup.ini, installed.db
+# is only parsed again when it changes.
 def get_installed_pkgs():
-    inst = []
-    with open("/etc/setup/installed.db") as f:
-        next(f)                 # Skip header
-        for line in f:
-            match = re.search(r'^(\S*) ', line)
-            inst.append(match.group(1))
+    db = "/etc/setup/installed.db"
+    st = os.stat(db)
+    key = (_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+    inst = read_cache('installed.db.pkl', key)
+    if inst is not None:
+        return inst
+    with open(db) as f:
+        lines = f.read().splitlines()
+    # Skip the header.  The package name is everything up to the first
+    # space.
+    inst = [sys.intern(line.partition(' ')[0])
+            for line in lines[1:] if ' ' in line]
+    write_cache('installed.db.pkl', key, inst)
     return inst
 
+# Number the vertices of a graph g, including those that only occur as
+# successors, in order of first appearance.  Return a pair (names,
+# adj): names[i] is vertex i, and adj[i] is the list of the numbers of
+# its successors.  A vertex that is not in g has no successors.
+def index_graph(g):
+    names = list(g)
+    ind = {v : i for i, v in enumerate(names)}
+    adj = []
+    for req in g.values():
+        succ = []
+        for w in req:
+            j = ind.get(w)
+            if j is None:
+                j = ind[w] = len(names)
+                names.append(w)
+            succ.append(j)
+        adj.append(succ)
+    adj.extend([] for _ in range(len(adj), len(names)))
+    return names, adj
+
+# Given the adjacency lists of a graph on vertices 0, ..., n-1, return
+# its strongly-connected components, as lists of vertices, in reverse
+# topological order: every SCC comes after all the SCCs it has arrows
+# to.  This is Tarjan's algorithm, with an explicit stack of (vertex,
+# successor iterator) pairs in place of recursion.
+def tarjan_sccs(adj):
+    n = len(adj)
+    index = [-1] * n
+    lowlink = [0] * n
+    on_stack = bytearray(n)
+    S = []
+    sccs = []
+    count = 0
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        index[root] = lowlink[root] = count
+        count += 1
+        S.append(root)
+        on_stack[root] = True
+        T = [(root, iter(adj[root]))]
+        while T:
+            v, it = T[-1]
+            for w in it:
+                if index[w] < 0:
+                    # Visit w, then come back to the rest of it.
+                    index[w] = lowlink[w] = count
+                    count += 1
+                    S.append(w)
+                    on_stack[w] = True
+                    T.append((w, iter(adj[w])))
+                    break
+                if on_stack[w] and index[w] < lowlink[v]:
+                    lowlink[v] = index[w]
+            else:
+                # Done with v.
+                T.pop()
+                if T:
+                    u = T[-1][0]
+                    if lowlink[v] < lowlink[u]:
+                        lowlink[u] = lowlink[v]
+                if lowlink[v] == index[v]:
+                    scc = []
+                    w = None
+                    while w != v:
+                        w = S.pop()
+                        on_stack[w] = False
+                        scc.append(w)
+                    sccs.append(scc)
+    return sccs
+
+# Return the strongly-connected components of a graph g, as lists of
+# vertices, in reverse topological order.
+def strongly_connected_components(g):
+    names, adj = index_graph(g)
+    return [[names[v] for v in c] for c in tarjan_sccs(adj)]
+
 # Given a graph g, return a list of strongly-connected components of
 # size > 1 that receive no arrows from any other SCC.
 def find_islands(g):
-    sccs = tarjan.tarjan(g)
-    # For each vertex, record the index of its scc.  Also declare the
-    # scc an island until we discover otherwise.
-    scc_ind = {}
-    is_island = []                # Index is index of scc.
+    names, adj = index_graph(g)
+    sccs = tarjan_sccs(adj)
+    # The sccs are in reverse topological order, so every scc that
+    # receives an arrow from a component C comes before C.  We can
+    # therefore do everything in one pass: record the index of each
+    # vertex's scc, declare C an island if it has more than one
+    # element, and mark as non-island every earlier scc that receives
+    # an edge from something in C.
+    scc_ind = [0] * len(names)
+    is_island = bytearray(len(sccs))   # Index is index of scc.
     for i, c in enumerate(sccs):
-        if len(c) > 1:
-            is_island.append(True)
-        else:
-            is_island.append(False)
         for v in c:
             scc_ind[v] = i
-
-    # For each component C, mark as non-island any earlier component
-    # that receives an edge from something in C.
-    for i, c in enumerate(sccs):
         for v in c:
-            for w in g[v]:
-                if scc_ind[w] < i:
-                    is_island[scc_ind[w]] = False
-
-    return [sccs[i] for i in range(len(sccs)) if is_island[i]]
+            for w in adj[v]:
+                j = scc_ind[w]
+                if j < i:
+                    is_island[j] = False
+        if len(c) > 1:
+            is_island[i] = True
+
+    return [[names[v] for v in sccs[i]] for i in range(len(sccs)) if is_island[i]]
+
+# Return the set of vertices reachable from src in the graph g.  src
+# itself is included only if it lies on a cycle.  A vertex that is not
+# in g (a missing dependency) has no successors.
+def reachable(g, src):
+    seen = set()
+    stack = [src]
+    while stack:
+        v = stack.pop()
+        for w in g.get(v, ()):
+            if w not in seen:
+                seen.add(w)
+                stack.append(w)
+    return seen
 
 # Reverse a graph g with vertex set V.
 def reverse(g, V):
-    h = defaultdict(list)
+    h = {p : [] for p in V}
+    for p, req in g.items():
+        for q in req:
+            lst = h.get(q)
+            if lst is not None:
+                lst.append(p)
+    return h
+
+# Given a dependency graph and a set of installed packages, generate
+# the pairs (p, q) where q is a dependency of p that is not in I.  The
+# pairs for a given p are consecutive.
+def iter_missing_deps(g, I):
     for p, req in g.items():
         for q in req:
-            h[q].append(p)
-    return {p : h[p] for p in V}
-
-# Given a dependency graph and a list of installed packages, return a
-# dictionary {p : req} where req is a list of dependencies of p that
-# are not in I.
-def find_missing_deps(g, I):
-    missing = defaultdict(list)
-    for p in g:
-        for q in g[p]:
-            if not q in I:
-                missing[p].append(q)
-    return missing
+            if q not in I:
+                yield p, q
 
 # Return a list of unknown installed packages (not listed in setup.ini).
 def find_unknown_pkgs(g, I):
@@ -160,13 +427,13 @@ def find_unknown_pkgs(g, I):
 # Return True if warnings were issued.
 def report_broken(g, I):
     ret = False
-    missing = find_missing_deps(g, I)
-    if missing:
-        ret = True
-        print("Missing dependencies:")
-        for p in missing:
-            print("%s: " % p, end='')
-            comma_print(missing[p])
+    missing = iter_missing_deps(g, I)
+    for p, pairs in itertools.groupby(missing, key=operator.itemgetter(0)):
+        if not ret:
+            ret = True
+            print("Missing dependencies:")
+        print("%s: " % p, end='')
+        comma_print([q for _, q in pairs])
     unknown = find_unknown_pkgs(g, I)
     if unknown:
         ret = True
@@ -178,6 +445,11 @@ def report_broken(g, I):
 def comma_print(l):
     print(','.join(l))
 
+# Print list items one per line, with a single write.
+def lines_print(l):
+    if l:
+        print('\n'.join(l))
+
 def main():
     parser = argparse.ArgumentParser(description='Find dependency information for Cygwin installation')
     parser.add_argument('-c', '--cached', action='store_true', help='use cached setup.ini file', required=False)
@@ -201,7 +473,7 @@ def main():
         print("%s doesn't exist" % inifile)
         sys.exit(1)
 
-    all_pkgs_graph, obs = parse_setup_ini(inifile)
+    all_pkgs_graph, obs = load_setup_ini(inifile)
 
     # Create working dependency graph g, which always includes 'BASE'.
     if not args.all:
@@ -211,19 +483,29 @@ def main():
         # therefore pretend that q is installed.  [We'll get a "missing
         # dependency" error if p is not installed.]
         set_inst = set(inst)
-        for p in inst:
-            set_inst |= set(all_pkgs_graph[p]) & obs
-        inst = list(set_inst)
-        inst_plus_base = inst[:]    # Copy by slicing.
-        inst_plus_base.append('BASE')
-        g = {p : all_pkgs_graph[p] for p in all_pkgs_graph if p in inst_plus_base}
+        if obs:
+            for p in inst:
+                set_inst.update(q for q in all_pkgs_graph.get(p, ())
+                                if q in obs)
+        # inst and inst_plus_base are only used for membership tests
+        # and iteration, so make them sets.
+        inst = frozenset(set_inst)
+        inst_plus_base = inst | {'BASE'}
+        # Iterate over items() so each adjacency list is reused without
+        # a second lookup.  Going through all_pkgs_graph rather than
+        # the (smaller) inst_plus_base keeps g in setup.ini order, so
+        # the output doesn't depend on set iteration order.
+        g = {p : req for p, req in all_pkgs_graph.items() if p in inst_plus_base}
     else:
         g = all_pkgs_graph
-        inst_plus_base = list(g.keys())
-        inst = inst_plus_base[:]
-        inst.remove('BASE')
-
-    if not args.quiet and not args.broken:
+        inst_plus_base = frozenset(g)
+        inst = inst_plus_base - {'BASE'}
+
+    # Only warn about broken dependencies for -R and -N.  Their answers
+    # follow dependencies transitively from one package, and a missing
+    # dependency silently cuts the search short.  The other queries
+    # report the graph as it stands; -b lists the problems itself.
+    if not args.quiet and (args.Requires or args.Needs):
         if report_broken(g, inst):
             print("\nWarning: The results that follow might be unreliable.\n")
 
@@ -235,37 +517,25 @@ def main():
             print("%s is not installed or not known." % args.package)
             sys.exit(1)
 
-    if args.requires or args.Requires or args.needs or args.Needs or args.leaves:
+    if args.needs or args.Needs or args.leaves:
         rev_g = reverse(g, inst_plus_base)
 
     if args.requires:
-        comma_print(sorted(g[args.package]))
+        comma_print(sorted(g.get(args.package, ())))
     elif args.Requires:
-        # tarjan.tc.tc() will fail with a KeyError if there were
-        # missing dependencies.
-        try:
-            h = tarjan.tc.tc(g)
-        except KeyError as err:
-            print("KeyError: %s" % format(err))
-            sys.exit(1)
-        comma_print(sorted(h[args.package]))
+        comma_print(sorted(reachable(g, args.package)))
     elif args.needs:
         comma_print(sorted(rev_g[args.package]))
     elif args.Needs:
-        comma_print(sorted(tarjan.tc.tc(rev_g)[args.package]))
+        comma_print(sorted(reachable(rev_g, args.package)))
     elif args.leaves:
-        leaves = sorted([p for p in inst if not rev_g[p]])
-        for p in leaves:
-            print(p)
+        lines_print(sorted([p for p in inst if not rev_g[p]]))
     elif args.islands:
         islands = find_islands(g)
-        for i in islands:
-            comma_print(sorted(i))
+        lines_print([','.join(sorted(i)) for i in islands])
     elif args.all_sccs:
-        sccs = tarjan.tarjan(g)
-        for c in sccs:
-            if len(c) > 1:
-                comma_print(sorted(c))
+        sccs = strongly_connected_components(g)
+        lines_print([','.join(sorted(c)) for c in sccs if len(c) > 1])
     elif args.broken:
         report_broken(g, inst)
 